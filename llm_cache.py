@@ -0,0 +1,103 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Default to /tmp since it is the only writable location on Vercel
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/tmp/llm_cache.sqlite")
+
+_lock = threading.Lock()
+_conn = None
+
+stats = {"hits": 0, "misses": 0}
+
+
+def _connection():
+    """Open the cache database on first use, creating the table and dropping expired rows."""
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(CACHE_PATH, check_same_thread=False, timeout=30)
+        try:
+            # WAL lets readers carry on while another process is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            _purge_expired(conn)
+            conn.commit()
+        except sqlite3.Error:
+            # Don't keep a half set-up connection; the next call will try again
+            conn.close()
+            raise
+        _conn = conn
+    return _conn
+
+
+def _purge_expired(conn):
+    """Delete rows whose expiry time has passed."""
+    conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+
+
+def make_key(model, question, batched=False):
+    """Build the cache key for a question sent to a given model.
+
+    Answers given as part of a batched prompt are keyed separately, since they
+    tend to be shorter than answers to the question asked on its own.
+    """
+    prefix = f"{model}\x00batch" if batched else model
+    return hashlib.sha256(f"{prefix}\x00{question}".encode()).hexdigest()
+
+
+def record(hits, misses):
+    """Add to the hit and miss counters."""
+    with _lock:
+        stats["hits"] += hits
+        stats["misses"] += misses
+
+
+def get_many(keys):
+    """Return a dict of the cached responses for keys, leaving out missing or expired ones."""
+    keys = list(keys)
+    now = time.time()
+    found = {}
+    with _lock:
+        conn = _connection()
+        # Stay well under SQLite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                "SELECT key, value, expires_at FROM responses WHERE key IN "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            for key, value, expires_at in rows:
+                if expires_at is None or expires_at >= now:
+                    found[key] = value
+    return found
+
+
+def get(key):
+    """Return the cached response for key, or None if missing or expired."""
+    value = get_many([key]).get(key)
+    record(int(value is not None), int(value is None))
+    return value
+
+
+def set_many(items, expire=None):
+    """Store (key, value) pairs in one transaction, optionally expiring after expire seconds."""
+    expires_at = time.time() + expire if expire is not None else None
+    with _lock:
+        conn = _connection()
+        with conn:
+            _purge_expired(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, value, expires_at) for key, value in items],
+            )
+
+
+def set(key, value, expire=None):
+    """Store value under key, optionally expiring after expire seconds."""
+    set_many([(key, value)], expire=expire)
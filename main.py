@@ -1,12 +1,29 @@
 from fastapi import FastAPI, File, Form, UploadFile, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import asyncio
+from dataclasses import dataclass
+import re
+import sqlite3
 import zipfile
 import os
-import io
 import logging
-from groq import Groq
+from pathlib import PurePosixPath
+import httpx
+from groq import AsyncGroq, APIConnectionError, APIError, BadRequestError, InternalServerError, RateLimitError
+from aiolimiter import AsyncLimiter
 import dotenv
-import pandas as pd
+import orjson
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+import llm_cache
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -30,134 +47,460 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 if not GROQ_API_KEY:
     logger.error("GROQ_API_KEY is missing. Please set it in the .env file.")
 
-client = Groq(
+# Share one pooled HTTP/2 connection across all Groq calls to avoid repeated TLS handshakes
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+
+client = AsyncGroq(
     api_key=os.environ.get("GROQ_API_KEY"),  # This is the default and can be omitted
+    http_client=http_client,
+    max_retries=0,  # Retries are handled by complete_choice() below
 )
 
+MODEL = "llama3-8b-8192"
+CACHE_TTL_SECONDS = 86400
+
+# Throttle outgoing requests so large CSVs stay under Groq's rate limits
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+
+semaphore = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+rate_limiter = AsyncLimiter(GROQ_RPM, 60)
+
+# Questions sent together in one prompt to amortize per-request overhead
+GROQ_BATCH_SIZE = int(os.getenv("GROQ_BATCH_SIZE", "10"))
+
+# Reject uploads that would expand into something too large to handle
+MAX_CSV_BYTES = int(os.getenv("MAX_CSV_BYTES", str(100 * 1024 * 1024)))
+MAX_COMPRESSION_RATIO = 100
+# Small archives are already bounded by MAX_CSV_BYTES; repeated questions compress very well
+COMPRESSION_RATIO_FLOOR_BYTES = 10 * 1024 * 1024
+
+_backoff = wait_random_exponential(min=1, max=30)
+
+
+def wait_retry_after(retry_state):
+    """Honour Groq's Retry-After header when present, otherwise back off with jitter."""
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), 60.0)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def complete_choice(question):
+    """Send a single question to Groq, respecting the concurrency and RPM limits."""
+    async with semaphore:
+        async with rate_limiter:
+            chat_completion = await client.chat.completions.create(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": question,
+                    }
+                ],
+                model=MODEL,
+            )
+    return chat_completion.choices[0]
+
+
+async def complete(question):
+    """Return Groq's answer to a single question."""
+    choice = await complete_choice(question)
+    return choice.message.content
+
+
+# Answers currently being fetched, keyed by question. Uploads are already
+# deduplicated, so this is for sharing one Groq request between concurrent uploads.
+in_flight = {}
+
+
+async def lookup_or_complete(question, check_cache=True):
+    """Answer a question from the response cache, falling back to Groq.
+
+    Pass check_cache=False when the caller has just looked the question up
+    (and counted the miss) itself.
+    """
+    # The cache is SQLite on disk, so keep its reads and writes off the event loop
+    key = llm_cache.make_key(MODEL, question)
+    if check_cache:
+        try:
+            cached = await asyncio.to_thread(llm_cache.get, key)
+        except sqlite3.Error as e:
+            # The cache is only an optimization, so treat a broken one as a miss
+            logger.warning(f"Could not read answer cache: {str(e)}")
+            cached = None
+        if cached is not None:
+            return cached
+
+    answer = await complete(question)
+    try:
+        await asyncio.to_thread(llm_cache.set, key, answer, expire=CACHE_TTL_SECONDS)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not cache answer: {str(e)}")
+    return answer
+
+
+# Matches "Answer 3:" at the start of a line, tolerating markdown such as "**Answer 3.**"
+ANSWER_MARKER = re.compile(r"^[ \t>#*_]*Answer\s*(\d+)[*_]*\s*[:.)-]?[*_]*[ \t]*", re.IGNORECASE | re.MULTILINE)
+
+
+def parse_numbered_answers(reply, count):
+    """Split an "Answer 1: ... Answer 2: ..." reply into a list of count answers.
+
+    An answer that is missing, empty or marked more than once comes back as None
+    so the caller can ask that question on its own.
+    """
+    if not reply:
+        return [None] * count
+
+    markers = [m for m in ANSWER_MARKER.finditer(reply) if 1 <= int(m.group(1)) <= count]
+    found = {}
+    for marker, next_marker in zip(markers, markers[1:] + [None]):
+        end = next_marker.start() if next_marker else len(reply)
+        number = int(marker.group(1))
+        # A number marked twice is ambiguous, so don't trust either copy
+        found[number] = None if number in found else reply[marker.end():end].strip() or None
+    return [found.get(i) for i in range(1, count + 1)]
+
+
+async def produce_single(question, check_cache, futures):
+    """Resolve the future for one question asked on its own."""
+    future, = futures
+    try:
+        future.set_result(await lookup_or_complete(question, check_cache))
+    except Exception as e:
+        future.set_exception(e)
+
+
+async def produce_batch(questions, futures):
+    """Resolve the futures for several questions with a single Groq call.
+
+    Any question the batched reply doesn't clearly answer is asked on its own.
+    """
+    prompt = (
+        "Answer each of the following questions separately. Start each answer on a "
+        'new line with "Answer N:", where N is the question number.\n\n'
+        + "\n".join(f"Question {i}: {question}" for i, question in enumerate(questions, start=1))
+    )
+    try:
+        choice = await complete_choice(prompt)
+        reply = choice.message.content
+    except BadRequestError as e:
+        # Groq rejected this prompt (e.g. too long for the context), so smaller ones may work
+        logger.warning(f"Batched request rejected, asking individually: {str(e)}")
+        reply = None
+    except APIError as e:
+        # Auth, rate-limit and connection errors would fail the same way for each question
+        for future in futures:
+            future.set_exception(e)
+        return
+
+    answers = parse_numbered_answers(reply, len(questions))
+    if reply is not None and choice.finish_reason == "length":
+        # The reply hit the token limit, so the last answer in it is probably cut short
+        answered = [i for i, answer in enumerate(answers) if answer is not None]
+        if answered:
+            answers[answered[-1]] = None
+
+    parsed = list(zip(questions, futures, answers))
+    batched = [(question, answer) for question, _, answer in parsed if answer is not None]
+    for _, future, answer in parsed:
+        if answer is not None:
+            future.set_result(answer)
+
+    if batched:
+        try:
+            await asyncio.to_thread(
+                llm_cache.set_many,
+                [(llm_cache.make_key(MODEL, question, batched=True), answer) for question, answer in batched],
+                expire=CACHE_TTL_SECONDS,
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Could not cache batched answers: {str(e)}")
+
+    missing = [(question, future) for question, future, answer in parsed if answer is None]
+    if reply is not None and missing:
+        logger.warning(f"{len(missing)} questions missing from batched reply, asking individually")
+    results = await asyncio.gather(
+        # ask_batch has already found these missing from the cache
+        *(lookup_or_complete(question, check_cache=False) for question, _ in missing),
+        return_exceptions=True,
+    )
+    for (_, future), result in zip(missing, results):
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+@dataclass
+class InFlight:
+    """An answer being fetched, shared by every caller asking the same question."""
+
+    future: asyncio.Future
+    task: asyncio.Task = None  # May answer several questions when they're batched
+    waiters: int = 0
+
+
+def _mark_retrieved(future):
+    """Consume a future's exception so an answer nobody waited for isn't logged as lost."""
+    if not future.cancelled():
+        future.exception()
+
+
+def start_in_flight(questions, produce, *args):
+    """Register questions as in flight and start produce(*args, futures) to answer them."""
+    loop = asyncio.get_running_loop()
+    entries = [InFlight(loop.create_future()) for _ in questions]
+    task = asyncio.create_task(produce(*args, [entry.future for entry in entries]))
+    for question, entry in zip(questions, entries):
+        entry.task = task
+        entry.future.add_done_callback(_mark_retrieved)
+        in_flight[question] = entry
+
+    def finish(_):
+        for question, entry in zip(questions, entries):
+            if in_flight.get(question) is entry:
+                del in_flight[question]
+            if not entry.future.done():
+                if task.cancelled():
+                    entry.future.cancel()
+                else:
+                    entry.future.set_exception(task.exception() or RuntimeError("No answer was produced."))
+
+    task.add_done_callback(finish)
+    return entries
+
+
+async def wait_for_answers(entries):
+    """Wait for in-flight answers, returning each one's result or exception.
+
+    If the last caller waiting on a request's outstanding answers goes away,
+    that request is cancelled rather than left spending the rate limit.
+    """
+    for entry in entries:
+        entry.waiters += 1
+    try:
+        if entries:
+            await asyncio.wait([entry.future for entry in entries])
+    finally:
+        for entry in entries:
+            entry.waiters -= 1
+        for task in {entry.task for entry in entries}:
+            siblings = {question: entry for question, entry in in_flight.items() if entry.task is task}
+            outstanding = [entry for entry in siblings.values() if not entry.future.done()]
+            if outstanding and not any(entry.waiters for entry in outstanding):
+                # Unregister now so a new caller starts a fresh request instead of joining this one
+                for question in siblings:
+                    del in_flight[question]
+                task.cancel()
+
+    results = []
+    for entry in entries:
+        if entry.future.cancelled():
+            results.append(RuntimeError("Answer was cancelled."))
+        else:
+            results.append(entry.future.exception() or entry.future.result())
+    return results
+
+
+async def ask(question):
+    """Answer a question, joining an identical request that is already in flight."""
+    entry = in_flight.get(question)
+    if entry is None:
+        entry, = start_in_flight([question], produce_single, question, True)
+    result, = await wait_for_answers([entry])
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+async def ask_batch(questions):
+    """Answer several distinct questions, sending the uncached ones as one batch.
+
+    Returns one entry per question, either the answer or the exception raised
+    for it. Questions another caller is already asking share that request.
+    """
+    # Either an answer to the question on its own or one from an earlier batch will do
+    keys = {question: llm_cache.make_key(MODEL, question) for question in questions}
+    batch_keys = {question: llm_cache.make_key(MODEL, question, batched=True) for question in questions}
+    try:
+        cached = await asyncio.to_thread(llm_cache.get_many, [*keys.values(), *batch_keys.values()])
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read answer cache: {str(e)}")
+        cached = {}
+
+    answers = {}
+    entries = {}
+    pending = []
+    for question in questions:
+        answer = cached.get(keys[question], cached.get(batch_keys[question]))
+        if question in in_flight:
+            entries[question] = in_flight[question]
+        elif answer is not None:
+            answers[question] = answer
+        else:
+            pending.append(question)
+    llm_cache.record(len(answers), len(pending))
+
+    if len(pending) > 1:
+        entries.update(zip(pending, start_in_flight(pending, produce_batch, pending)))
+    elif pending:
+        entries.update(zip(pending, start_in_flight(pending, produce_single, pending[0], False)))
+
+    results = await wait_for_answers(list(entries.values()))
+    answers.update(zip(entries, results))
+
+    return [answers[question] for question in questions]
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close the shared HTTP client when the server stops."""
+    await http_client.aclose()
+
+
 class QuestionRequest(BaseModel):
     question: str  # Ensures the question is a string
 
 
-'''
-@app.post("/api/")
-async def process_request(file: UploadFile = File(...)):
-  # Validate API Key
-  if not GROQ_API_KEY:
-    raise HTTPException(status_code=500, detail="Missing API Key. Check .env file.")
-
-  try:
-        # Check if the uploaded file is a ZIP file
-    if not file.filename.endswith(".zip"):
-       raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file.")
-    
-    # Read the contents of the uploaded ZIP file
-    contents = await file.read()
-    zip_buffer = io.BytesIO(contents)
-
-        # Extract ZIP file and validate its contents
-    with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
-        file_names = zip_ref.namelist()
-
-            # Ensure only one CSV file is inside the ZIP
+def is_unsafe_path(filename):
+    """Return True if a ZIP member name is absolute or climbs out of the archive."""
+    return (
+        filename.startswith(("/", "\\"))
+        or re.match(r"^[A-Za-z]:", filename) is not None
+        or ".." in PurePosixPath(filename.replace("\\", "/")).parts
+    )
+
+
+def load_questions(zip_file):
+    """Read the questions out of the single CSV inside an uploaded ZIP file."""
+    # Open the ZIP straight from the spooled upload instead of copying it into memory
+    zip_file.seek(0)
+
+    # Extract ZIP file and validate its contents
+    try:
+        zip_ref = zipfile.ZipFile(zip_file, 'r')
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid ZIP file.")
+
+    with zip_ref:
+        file_infos = zip_ref.infolist()
+
+        # Guard against zip bombs and path traversal using only the central directory
+        for info in file_infos:
+            if info.file_size > MAX_CSV_BYTES:
+                raise HTTPException(status_code=400, detail="CSV file in ZIP is too large.")
+            if is_unsafe_path(info.filename):
+                raise HTTPException(status_code=400, detail="ZIP contains an invalid file path.")
+
+        total_size = sum(info.file_size for info in file_infos)
+        compressed_size = sum(info.compress_size for info in file_infos)
+        if (
+            total_size > COMPRESSION_RATIO_FLOOR_BYTES
+            and compressed_size
+            and total_size / compressed_size > MAX_COMPRESSION_RATIO
+        ):
+            raise HTTPException(status_code=400, detail="ZIP compression ratio is suspiciously high.")
+
+        file_names = [info.filename for info in file_infos]
+
+        # Ensure only one CSV file is inside the ZIP
         if len(file_names) != 1 or not file_names[0].endswith(".csv"):
             raise HTTPException(status_code=400, detail="ZIP must contain exactly one CSV file.")
-        
-        # Extract the CSV file to a temporary directory
-        zip_ref.extract(file_names[0], path="extracted_files")
-
-        csv_file_path = os.path.join("extracted_files", file_names[0])
-        
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(csv_file_path)
-        logger.info("CSV file read successfully.")
-    
-    print("CSV file read successfully.")
-    print(df.head())  # Display the first few rows of the DataFrame
-    
-    answers = dict()
-
-    for question in df['question']:
-        chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": question,
-            }
-        ],
-        model="llama3-8b-8192",
+
+        # Stream the CSV straight out of the archive with pyarrow, only converting the
+        # question column. Opening the reader checks the header, so a CSV without a
+        # question column is rejected before the rest of the file is parsed.
+        convert_options = pa_csv.ConvertOptions(
+            include_columns=["question"], column_types={"question": pa.string()}
         )
-        answers[question] = chat_completion.choices[0].message.content
+        questions = []
+        with zip_ref.open(file_names[0]) as csv_file:
+            try:
+                reader = pa_csv.open_csv(csv_file, convert_options=convert_options)
+                for batch in reader:
+                    questions.extend(batch.column("question").to_pylist())
+            except pa.ArrowKeyError:
+                raise HTTPException(status_code=400, detail="CSV must contain a 'question' column.")
+            except pa.ArrowInvalid as e:
+                raise HTTPException(status_code=400, detail=f"Could not read questions from CSV: {str(e)}")
+
+    return questions
+
+
+async def answer_batch(batch):
+    """Pair a batch of questions with their answers.
+
+    Anything ask_batch doesn't handle itself is reported against every question
+    in the batch, so one bad batch can't cut the stream short.
+    """
+    try:
+        results = await ask_batch(batch)
+    except Exception as e:
+        results = [e] * len(batch)
+    return batch, results
 
-    # delete the ectracted file
-    # os.remove(os.path.join("extracted_files", file_names[0]))
-    print("CSV file extracted and deleted successfully.")
-    return answers
-  except Exception as e:
-    print(f"Unexpected error: {str(e)}")
-    return {"error": str(e)}
-'''
 
+async def stream_answers(batches):
+    """Yield one {question: answer} JSON line per question as each batch finishes."""
+    tasks = [asyncio.create_task(answer_batch(batch)) for batch in batches]
+    # A failed batch shares one exception across its questions; log its traceback once
+    logged_errors = set()
+    try:
+        for next_batch in asyncio.as_completed(tasks):
+            batch, results = await next_batch
+            for question, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    if result in logged_errors:
+                        logger.error(f"Failed to answer {question!r}: {str(result)}")
+                    else:
+                        logged_errors.add(result)
+                        logger.error(f"Failed to answer {question!r}", exc_info=result)
+                    result = {"error": str(result)}
+                yield orjson.dumps({question: result}, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+    finally:
+        # Stop outstanding requests if the client disconnects early
+        for task in tasks:
+            task.cancel()
+
+    logger.info(f"LLM cache hits: {llm_cache.stats['hits']}, misses: {llm_cache.stats['misses']}")
 
 
 @app.post("/api/")
 async def process_request(files: UploadFile = File(...)):
-    print(files.filename)
     # Validate API Key
     if not GROQ_API_KEY:
         raise HTTPException(status_code=500, detail="Missing API Key. Check .env file.")
 
-    try:
-        # Check if the uploaded file is a ZIP file
-        if not files.filename.endswith(".zip"):
-            raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file.")
-        
-        # Read the contents of the uploaded ZIP file
-        contents = await files.read()
-        zip_buffer = io.BytesIO(contents)
-
-        # Extract ZIP file and validate its contents
-        with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
-            file_names = zip_ref.namelist()
-
-            # Ensure only one CSV file is inside the ZIP
-            if len(file_names) != 1 or not file_names[0].endswith(".csv"):
-                raise HTTPException(status_code=400, detail="ZIP must contain exactly one CSV file.")
-            
-            # Extract the CSV file to a temporary directory
-            extracted_dir = "/tmp/extracted_files"
-
-            os.makedirs(extracted_dir, exist_ok=True)
-            zip_ref.extract(file_names[0], path=extracted_dir)
-
-            csv_file_path = os.path.join(extracted_dir, file_names[0])
-            
-            # Read the CSV file into a DataFrame
-            df = pd.read_csv(csv_file_path)
-            logger.info("CSV file read successfully.")
-        
-        print("CSV file read successfully.")
-        print(df.head())  # Display the first few rows of the DataFrame
-        
-        answers = dict()
-
-        for question in df['question']:
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": question,
-                    }
-                ],
-                model="llama3-8b-8192",
-            )
-            answers[question] = chat_completion.choices[0].message.content
+    # Check if the uploaded file is a ZIP file
+    if not files.filename.endswith(".zip"):
+        raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file.")
 
-        # Delete the extracted CSV file after processing
-        os.remove(csv_file_path)
-        print("CSV file extracted and deleted successfully.")
-        
-        return answers
+    # Unzipping and parsing are blocking, so run them off the event loop
+    questions = await asyncio.to_thread(load_questions, files.file)
+    logger.info("received=%s rows=%d", files.filename, len(questions))
 
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        return {"error": str(e)}
+    # Only ask each distinct question once; answers are keyed by question anyway
+    questions = list(dict.fromkeys(questions))
+
+    # Group questions into batches; complete() keeps the underlying requests
+    # within rate limits
+    batches = [
+        questions[i:i + GROQ_BATCH_SIZE] for i in range(0, len(questions), GROQ_BATCH_SIZE)
+    ]
+
+    return StreamingResponse(stream_answers(batches), media_type="application/x-ndjson")
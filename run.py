@@ -1,6 +1,11 @@
+import json
 import requests
 
 url = "http://127.0.0.1:8000/api/"
 file = {"files": open("abcd.zip", "rb")}
-response = requests.post(url, files=file)
-print(response.json())
+response = requests.post(url, files=file, stream=True)
+
+# Answers are streamed back as one JSON object per line
+for line in response.iter_lines():
+    if line:
+        print(json.loads(line))
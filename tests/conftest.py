@@ -0,0 +1,10 @@
+import pytest
+
+import llm_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(tmp_path, monkeypatch):
+    """Give each test its own empty response cache."""
+    monkeypatch.setattr(llm_cache, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(llm_cache, "_conn", None)
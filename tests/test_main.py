@@ -0,0 +1,357 @@
+import asyncio
+import io
+import zipfile
+from types import SimpleNamespace
+
+import httpx
+import orjson
+import pytest
+from aiolimiter import AsyncLimiter
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from groq import AuthenticationError, BadRequestError, RateLimitError
+from tenacity import wait_none
+
+import llm_cache
+import main
+
+
+def groq_error(error_class, status_code, headers=None):
+    """Build a Groq API error as the SDK would raise it for a given status code."""
+    request = httpx.Request("POST", "https://api.groq.com/openai/v1/chat/completions")
+    response = httpx.Response(status_code, request=request, headers=headers)
+    return error_class("error", response=response, body=None)
+
+
+def as_choice(fake_complete, finish_reason="stop"):
+    """Wrap a fake prompt -> text function as a stand-in for complete_choice."""
+    async def fake_complete_choice(prompt):
+        content = await fake_complete(prompt)
+        return SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish_reason)
+
+    return fake_complete_choice
+
+
+def make_zip(name, data):
+    """Build an in-memory ZIP holding a single member."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(name, data)
+    return buffer
+
+
+@pytest.mark.parametrize(
+    "filename",
+    ["questions.csv", "data/questions.csv", "q..v2.csv"],
+)
+def test_is_unsafe_path_allows_normal_names(filename):
+    assert not main.is_unsafe_path(filename)
+
+
+@pytest.mark.parametrize(
+    "filename",
+    ["../questions.csv", "data/../../questions.csv", "/etc/passwd", "\\questions.csv",
+     "..\\questions.csv", "C:questions.csv", "C:\\questions.csv"],
+)
+def test_is_unsafe_path_rejects_escaping_names(filename):
+    assert main.is_unsafe_path(filename)
+
+
+def test_load_questions_accepts_highly_repetitive_csv():
+    csv = "question\n" + "What is the capital of France?\n" * 5000
+    questions = main.load_questions(make_zip("questions.csv", csv))
+    assert len(questions) == 5000
+
+
+def test_load_questions_rejects_csv_without_question_column():
+    with pytest.raises(HTTPException) as excinfo:
+        main.load_questions(make_zip("questions.csv", "prompt,answer\nWhat is 2+2?,4\n"))
+    assert excinfo.value.status_code == 400
+    assert "question" in excinfo.value.detail
+
+
+def test_load_questions_rejects_path_traversal():
+    with pytest.raises(HTTPException) as excinfo:
+        main.load_questions(make_zip("../questions.csv", "question\nWhat is 2+2?\n"))
+    assert excinfo.value.status_code == 400
+
+
+def test_parse_numbered_answers_splits_in_order():
+    reply = "Answer 1: 4\nAnswer 2: Paris"
+    assert main.parse_numbered_answers(reply, 2) == ["4", "Paris"]
+
+
+def test_parse_numbered_answers_keeps_numbered_lists_inside_answers():
+    reply = (
+        "Answer 1: To make tea:\n1. Boil water\n2. Add the tea bag\n"
+        "Answer 2: Paris"
+    )
+    assert main.parse_numbered_answers(reply, 2) == [
+        "To make tea:\n1. Boil water\n2. Add the tea bag",
+        "Paris",
+    ]
+
+
+def test_parse_numbered_answers_tolerates_markdown():
+    reply = "**Answer 1:** 4\n\n### Answer 2.\nParis"
+    assert main.parse_numbered_answers(reply, 2) == ["4", "Paris"]
+
+
+def test_parse_numbered_answers_marks_missing_and_duplicate_answers():
+    reply = "Answer 1: 4\nAnswer 3: Blue\nAnswer 3: Green"
+    assert main.parse_numbered_answers(reply, 3) == ["4", None, None]
+
+
+@pytest.mark.parametrize("reply", [None, "", "I can't help with that."])
+def test_parse_numbered_answers_without_markers(reply):
+    assert main.parse_numbered_answers(reply, 2) == [None, None]
+
+
+def test_ask_batch_asks_unparsed_questions_individually(monkeypatch):
+    prompts = []
+
+    async def fake_complete(prompt):
+        prompts.append(prompt)
+        if prompt.startswith("Answer each"):
+            return "Answer 1: 4"
+        return "Paris"
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    answers = asyncio.run(main.ask_batch(["What is 2+2?", "Capital of France?"]))
+
+    assert answers == ["4", "Paris"]
+    assert prompts[1:] == ["Capital of France?"]
+
+
+def test_truncated_batch_reply_re_asks_the_last_answer(monkeypatch):
+    prompts = []
+
+    async def fake_complete(prompt):
+        prompts.append(prompt)
+        if prompt.startswith("Answer each"):
+            return "Answer 1: 4\nAnswer 2: The capital of Fra"
+        return "Paris"
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete, finish_reason="length"))
+    answers = asyncio.run(main.ask_batch(["What is 2+2?", "Capital of France?"]))
+
+    assert answers == ["4", "Paris"]
+    assert prompts[1:] == ["Capital of France?"]
+
+
+def test_batch_fails_fast_on_errors_every_question_would_hit(monkeypatch):
+    prompts = []
+
+    async def fake_complete(prompt):
+        prompts.append(prompt)
+        raise groq_error(AuthenticationError, 401)
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    answers = asyncio.run(main.ask_batch(["What is 2+2?", "Capital of France?"]))
+
+    assert len(prompts) == 1
+    assert all(isinstance(answer, AuthenticationError) for answer in answers)
+
+
+def test_rejected_batch_prompt_falls_back_to_single_questions(monkeypatch):
+    async def fake_complete(prompt):
+        if prompt.startswith("Answer each"):
+            raise groq_error(BadRequestError, 400)
+        return prompt.upper()
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    answers = asyncio.run(main.ask_batch(["what is 2+2?", "capital of france?"]))
+
+    assert answers == ["WHAT IS 2+2?", "CAPITAL OF FRANCE?"]
+
+
+def test_answer_batch_reports_unexpected_errors_per_question(monkeypatch):
+    async def broken_ask_batch(questions):
+        raise TypeError("boom")
+
+    monkeypatch.setattr(main, "ask_batch", broken_ask_batch)
+    batch, results = asyncio.run(main.answer_batch(["a", "b"]))
+
+    assert batch == ["a", "b"]
+    assert [str(result) for result in results] == ["boom", "boom"]
+
+
+def test_batched_answers_are_not_reused_for_single_questions(monkeypatch):
+    async def fake_complete(prompt):
+        if prompt.startswith("Answer each"):
+            return "Answer 1: 4\nAnswer 2: Paris"
+        return "The capital of France is Paris."
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    asyncio.run(main.ask_batch(["What is 2+2?", "Capital of France?"]))
+
+    assert asyncio.run(main.ask_batch(["What is 2+2?", "Capital of France?"])) == ["4", "Paris"]
+    assert asyncio.run(main.ask("Capital of France?")) == "The capital of France is Paris."
+
+
+def test_concurrent_batches_share_one_request(monkeypatch):
+    prompts = []
+
+    async def fake_complete(prompt):
+        prompts.append(prompt)
+        await asyncio.sleep(0.01)
+        return "Answer 1: 4\nAnswer 2: Paris"
+
+    async def run():
+        questions = ["What is 2+2?", "Capital of France?"]
+        return await asyncio.gather(main.ask_batch(questions), main.ask_batch(questions))
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    first, second = asyncio.run(run())
+
+    assert first == second == ["4", "Paris"]
+    assert len(prompts) == 1
+    assert main.in_flight == {}
+
+
+def test_last_waiter_leaving_cancels_the_request(monkeypatch):
+    cancelled = []
+
+    async def fake_complete(prompt):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(prompt)
+            raise
+
+    async def run():
+        task = asyncio.create_task(main.ask_batch(["What is 2+2?", "Capital of France?"]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    asyncio.run(run())
+
+    assert len(cancelled) == 1
+    assert main.in_flight == {}
+
+
+def test_request_keeps_running_while_another_caller_waits(monkeypatch):
+    async def fake_complete(prompt):
+        await asyncio.sleep(0.05)
+        return "Answer 1: 4\nAnswer 2: Paris"
+
+    async def run():
+        questions = ["What is 2+2?", "Capital of France?"]
+        leaving = asyncio.create_task(main.ask_batch(questions))
+        await asyncio.sleep(0.01)
+        staying = asyncio.create_task(main.ask_batch(questions))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        return await staying
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    assert asyncio.run(run()) == ["4", "Paris"]
+
+
+def test_cache_misses_are_counted_once_per_question(monkeypatch):
+    async def fake_complete(prompt):
+        return "no markers here" if prompt.startswith("Answer each") else "answer"
+
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    monkeypatch.setattr(llm_cache, "stats", {"hits": 0, "misses": 0})
+    asyncio.run(main.ask_batch(["a", "b", "c"]))
+    asyncio.run(main.ask_batch(["d"]))
+    asyncio.run(main.ask_batch(["a", "d"]))
+
+    assert llm_cache.stats == {"hits": 2, "misses": 4}
+
+
+def test_shared_batch_error_traceback_is_logged_once(monkeypatch, caplog):
+    async def broken_ask_batch(questions):
+        raise TypeError("boom")
+
+    async def collect(batches):
+        return [line async for line in main.stream_answers(batches)]
+
+    monkeypatch.setattr(main, "ask_batch", broken_ask_batch)
+    lines = asyncio.run(collect([["a", "b", "c"]]))
+
+    assert len(lines) == 3
+    failures = [record for record in caplog.records if record.getMessage().startswith("Failed to answer")]
+    assert len(failures) == 3
+    assert sum(record.exc_info is not None for record in failures) == 1
+
+
+def retry_state_for(error, attempt_number=1):
+    """Build the bit of tenacity's retry state that wait_retry_after reads."""
+    return SimpleNamespace(outcome=SimpleNamespace(exception=lambda: error), attempt_number=attempt_number)
+
+
+def test_wait_retry_after_honours_header():
+    error = groq_error(RateLimitError, 429, headers={"retry-after": "7"})
+    assert main.wait_retry_after(retry_state_for(error)) == 7.0
+
+
+def test_wait_retry_after_caps_long_header_values():
+    error = groq_error(RateLimitError, 429, headers={"retry-after": "3600"})
+    assert main.wait_retry_after(retry_state_for(error)) == 60.0
+
+
+def test_wait_retry_after_backs_off_without_header():
+    error = groq_error(RateLimitError, 429)
+    assert 0 <= main.wait_retry_after(retry_state_for(error, attempt_number=3)) <= 30
+
+
+def test_complete_choice_retries_rate_limits_but_not_auth_errors(monkeypatch):
+    errors = [groq_error(RateLimitError, 429), groq_error(RateLimitError, 429)]
+    calls = []
+
+    async def fake_create(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="4"))])
+
+    monkeypatch.setattr(main.client.chat.completions, "create", fake_create)
+    # AsyncLimiter is tied to one event loop, and each asyncio.run starts a new one
+    monkeypatch.setattr(main, "rate_limiter", AsyncLimiter(main.GROQ_RPM, 60))
+    complete_choice = main.complete_choice.retry_with(wait=wait_none())
+
+    assert asyncio.run(complete_choice("What is 2+2?")).message.content == "4"
+    assert len(calls) == 3
+
+    async def unauthorized(**kwargs):
+        calls.append(kwargs)
+        raise groq_error(AuthenticationError, 401)
+
+    monkeypatch.setattr(main.client.chat.completions, "create", unauthorized)
+    monkeypatch.setattr(main, "rate_limiter", AsyncLimiter(main.GROQ_RPM, 60))
+    with pytest.raises(AuthenticationError):
+        asyncio.run(complete_choice("What is 2+2?"))
+    assert len(calls) == 4
+
+
+def test_api_streams_one_json_line_per_question(monkeypatch):
+    async def fake_complete(prompt):
+        return "Answer 1: 4\nAnswer 2: Paris"
+
+    monkeypatch.setattr(main, "GROQ_API_KEY", "test-key")
+    monkeypatch.setattr(main, "complete_choice", as_choice(fake_complete))
+    csv = "question,answer\nWhat is 2+2?,\nCapital of France?,\nWhat is 2+2?,\n"
+
+    # Not used as a context manager, so the shutdown handler doesn't close the shared HTTP client
+    response = TestClient(main.app).post(
+        "/api/", files={"files": ("questions.zip", make_zip("questions.csv", csv).getvalue())}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [orjson.loads(line) for line in response.text.splitlines()]
+    assert lines == [{"What is 2+2?": "4"}, {"Capital of France?": "Paris"}]
+
+
+def test_api_rejects_non_zip_uploads(monkeypatch):
+    monkeypatch.setattr(main, "GROQ_API_KEY", "test-key")
+
+    response = TestClient(main.app).post("/api/", files={"files": ("questions.csv", b"question\n")})
+
+    assert response.status_code == 400